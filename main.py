@@ -1,18 +1,50 @@
 import os
-import subprocess
+import re
 import asyncio
 import json
+import logging
 import time
-import tempfile
+import hashlib
 from typing import Dict, Optional
 
 import decky
 
+# orjson is faster when available; fall back to the stdlib otherwise
+try:
+    import orjson
+
+    def _loads(data: bytes):
+        return orjson.loads(data)
+
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:
+    def _loads(data: bytes):
+        return json.loads(data)
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, indent=2).encode()
+
+# Average from the iputils summary line: "rtt min/avg/max/mdev = 1.2/3.4/5.6/0.7 ms"
+_RTT_AVG_RE = re.compile(rb'rtt [^=]+= [\d.]+/([\d.]+)/')
+
+# Pings sent per check and the overall deadline for them, as in the wifitoggler script
+_PING_COUNT = 4
+_PING_TIMEOUT = 10.0
+
+# Minimum latency change (ms) before an unchanged status is emitted again
+_LATENCY_EMIT_DELTA = 5
+
+# Constant wifi_status_changed payloads; never mutate these
+_EVT_MON_ON = {"monitoring": True}
+_EVT_MON_OFF = {"monitoring": False}
+
 class Plugin:
     def __init__(self):
-        self.script_process: Optional[asyncio.subprocess.Process] = None
+        self.monitor_task: Optional[asyncio.Task] = None
+        self._stop_evt: Optional[asyncio.Event] = None
         self.is_monitoring = False
-        self.script_path = os.path.join(os.path.dirname(__file__), "wifitoggler")
+        self.settings_file = os.path.join(decky.DECKY_PLUGIN_SETTINGS_DIR, "LotusWiFi.json")
         self.settings = {
             "max_latency": 100,
             "check_interval": 10,
@@ -25,19 +57,23 @@ class Plugin:
             "timestamp": 0
         }
         self.restart_count = 0
+        self._last_emitted: Optional[Dict] = None
+        self._settings_hash: Optional[str] = None
 
     async def get_settings(self) -> Dict:
         """Get current plugin settings"""
         return self.settings
 
     async def update_settings(self, new_settings: Dict) -> bool:
-        """Update plugin settings and restart script if running"""
+        """Update plugin settings and restart monitoring if running"""
         try:
             old_settings = self.settings.copy()
             self.settings.update(new_settings)
+            if self.settings == old_settings:
+                return True
             await self._save_settings()
             
-            # If monitoring and settings changed, restart the script
+            # If monitoring and settings changed, restart the monitoring loop
             if self.is_monitoring and (
                 old_settings["max_latency"] != self.settings["max_latency"] or
                 old_settings["check_interval"] != self.settings["check_interval"] or
@@ -62,176 +98,193 @@ class Plugin:
         }
 
     async def start_monitoring(self) -> bool:
-        """Start the Wi-Fi monitoring script"""
+        """Start the Wi-Fi monitoring loop"""
         if self.is_monitoring:
             return True
             
         try:
-            # Create a modified version of the script with current settings
-            modified_script = await self._create_configured_script()
-            
-            # Start the script process
-            self.script_process = await asyncio.create_subprocess_exec(
-                "bash", modified_script,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
             self.is_monitoring = True
             self.settings["enabled"] = True
+            self._last_emitted = None
             
-            # Start monitoring the script output
-            asyncio.create_task(self._monitor_script_output())
+            self._stop_evt = asyncio.Event()
+            self.monitor_task = asyncio.create_task(self._monitor_loop(self._stop_evt))
             
-            decky.logger.info("Wi-Fi monitoring script started")
-            await decky.emit("wifi_status_changed", {"monitoring": True})
+            decky.logger.info("Wi-Fi monitoring started")
+            await decky.emit("wifi_status_changed", _EVT_MON_ON)
             return True
             
         except Exception as e:
-            decky.logger.error(f"Failed to start monitoring script: {e}")
+            decky.logger.error(f"Failed to start monitoring: {e}")
             self.is_monitoring = False
             return False
 
     async def stop_monitoring(self) -> bool:
-        """Stop the Wi-Fi monitoring script"""
+        """Stop the Wi-Fi monitoring loop"""
         try:
             self.is_monitoring = False
             self.settings["enabled"] = False
             
-            if self.script_process:
-                # Send SIGTERM to gracefully stop the script
-                self.script_process.terminate()
-                try:
-                    await asyncio.wait_for(self.script_process.wait(), timeout=5.0)
-                except asyncio.TimeoutError:
-                    # Force kill if it doesn't stop gracefully
-                    self.script_process.kill()
-                    await self.script_process.wait()
-                self.script_process = None
+            if self._stop_evt:
+                self._stop_evt.set()
+                self._stop_evt = None
+
+            if self.monitor_task:
+                # Also interrupt a ping or Wi-Fi restart that is in flight
+                self.monitor_task.cancel()
+                # Bounded so a stuck child can't hang plugin shutdown
+                _, pending = await asyncio.wait({self.monitor_task}, timeout=5.0)
+                if pending:
+                    decky.logger.warning("Monitoring task did not stop in time; detaching")
+                self.monitor_task = None
             
-            decky.logger.info("Wi-Fi monitoring script stopped")
-            await decky.emit("wifi_status_changed", {"monitoring": False})
+            decky.logger.info("Wi-Fi monitoring stopped")
+            await decky.emit("wifi_status_changed", _EVT_MON_OFF)
             return True
             
         except Exception as e:
-            decky.logger.error(f"Failed to stop monitoring script: {e}")
+            decky.logger.error(f"Failed to stop monitoring: {e}")
             return False
 
-    async def _create_configured_script(self) -> str:
-        """Create a temporary script file with current settings"""
+    async def _monitor_loop(self, stop_evt: asyncio.Event):
+        """Ping the configured host and restart Wi-Fi on high latency until stop_evt is set"""
         try:
-            # Read the original script
-            with open(self.script_path, 'r') as f:
-                script_content = f.read()
-            
-            # Replace the configuration variables
-            script_content = script_content.replace(
-                'MAX_LATENCY=100', 
-                f'MAX_LATENCY={self.settings["max_latency"]}'
-            )
-            script_content = script_content.replace(
-                'CHECK_INTERVAL=10', 
-                f'CHECK_INTERVAL={self.settings["check_interval"]}'
-            )
-            script_content = script_content.replace(
-                'PING_HOST="8.8.8.8"', 
-                f'PING_HOST="{self.settings["ping_host"]}"'
-            )
-            
-            # Create temporary file
-            temp_fd, temp_path = tempfile.mkstemp(suffix='.sh', prefix='lotuswifi_')
-            with os.fdopen(temp_fd, 'w') as temp_file:
-                temp_file.write(script_content)
-            
-            # Make it executable
-            os.chmod(temp_path, 0o755)
-            
-            return temp_path
-            
-        except Exception as e:
-            decky.logger.error(f"Failed to create configured script: {e}")
-            raise
+            while True:
+                latency = await self._ping(self.settings["ping_host"])
+                if decky.logger.isEnabledFor(logging.DEBUG):
+                    decky.logger.debug("Ping %s: %s", self.settings["ping_host"], latency)
 
-    async def _monitor_script_output(self):
-        """Monitor the script output for status updates"""
-        if not self.script_process:
-            return
-            
-        try:
-            while self.is_monitoring and self.script_process:
-                line = await self.script_process.stdout.readline()
-                if not line:
-                    break
-                    
-                line_str = line.decode().strip()
-                decky.logger.info(f"Script output: {line_str}")
-                
-                # Parse the output for status information
-                await self._parse_script_output(line_str)
-                
-        except Exception as e:
-            decky.logger.error(f"Error monitoring script output: {e}")
-        finally:
-            if self.is_monitoring:
-                self.is_monitoring = False
-                await decky.emit("wifi_status_changed", {"monitoring": False})
+                if latency is None:
+                    self.last_status = {
+                        "latency": -1,
+                        "status": "failed",
+                        "timestamp": int(time.time())
+                    }
+                    await self._emit_ping_result()
 
-    async def _parse_script_output(self, line: str):
-        """Parse script output to extract status information"""
-        try:
-            current_time = int(time.time())
-            
-            if "Ping OK" in line:
-                # Extract latency from "Ping OK (XXXms)" format
-                import re
-                match = re.search(r'Ping OK \((\d+(?:\.\d+)?)ms\)', line)
-                if match:
-                    latency = float(match.group(1))
+                # Compare whole milliseconds, as the script did after cut -d'.' -f1
+                elif int(latency) > self.settings["max_latency"]:
                     self.last_status = {
                         "latency": latency,
-                        "status": "ok",
-                        "timestamp": current_time
+                        "status": "high",
+                        "timestamp": int(time.time())
                     }
-                    await decky.emit("ping_result", self.last_status)
-                    
-            elif "High latency detected" in line:
-                # Extract latency from "High latency detected (XXXms)" format
-                import re
-                match = re.search(r'High latency detected \((\d+(?:\.\d+)?)ms\)', line)
-                if match:
-                    latency = float(match.group(1))
+                    await self._emit_ping_result()
+                    await self._restart_wifi()
+
+                else:
                     self.last_status = {
                         "latency": latency,
-                        "status": "high",
-                        "timestamp": current_time
+                        "status": "ok",
+                        "timestamp": int(time.time())
                     }
-                    await decky.emit("ping_result", self.last_status)
-                    
-            elif "Restarting Wi-Fi" in line:
-                self.restart_count += 1
-                await decky.emit("wifi_restarted", {
-                    "count": self.restart_count, 
-                    "reason": f"High latency detected"
-                })
-                
-            elif "Ping failed or timed out" in line:
-                self.last_status = {
-                    "latency": -1,
-                    "status": "failed",  
-                    "timestamp": current_time
-                }
-                await decky.emit("ping_result", self.last_status)
+                    await self._emit_ping_result()
+
+                # Sleep until the next check, waking immediately when stopped
+                try:
+                    await asyncio.wait_for(stop_evt.wait(), timeout=self.settings["check_interval"])
+                    break
+                except asyncio.TimeoutError:
+                    pass
                 
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            decky.logger.error(f"Error parsing script output: {e}")
+            decky.logger.error(f"Error in monitoring loop: {e}")
+        finally:
+            # Only report the stop here if the loop died on its own
+            if not stop_evt.is_set():
+                self.is_monitoring = False
+                await decky.emit("wifi_status_changed", _EVT_MON_OFF)
+
+    async def _ping(self, host: str) -> Optional[float]:
+        """Return the average round-trip time to host in ms, or None on failure"""
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                "ping", "-c", str(_PING_COUNT), "-q", str(host),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+        except OSError as e:
+            # Count it as a failed check and try again next interval
+            decky.logger.error(f"Failed to run ping: {e}")
+            return None
+        try:
+            output, _ = await asyncio.wait_for(proc.communicate(), timeout=_PING_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                try:
+                    await asyncio.wait_for(proc.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    # Ignored SIGKILL (uninterruptible sleep); nothing more we can do
+                    decky.logger.warning(f"ping (pid {proc.pid}) unkillable; detaching")
+
+        match = _RTT_AVG_RE.search(output)
+        return float(match.group(1)) if match else None
+
+    async def _restart_wifi(self):
+        """Toggle the Wi-Fi radio off and back on"""
+        self.restart_count += 1
+        decky.logger.info("High latency detected, restarting Wi-Fi")
+        await decky.emit("wifi_restarted", {
+            "count": self.restart_count,
+            "reason": "High latency detected"
+        })
+
+        # Never leave the radio blocked, even if monitoring is stopped mid-restart:
+        # the toggle runs shielded and is allowed to finish before cancelling
+        toggle = asyncio.ensure_future(self._toggle_radio())
+        try:
+            await asyncio.shield(toggle)
+        except asyncio.CancelledError:
+            await toggle
+            raise
+
+    async def _toggle_radio(self):
+        """Block the Wi-Fi radio for a second, then unblock it"""
+        try:
+            await self._rfkill("block")
+            await asyncio.sleep(1)
+        finally:
+            await self._rfkill("unblock")
+
+    async def _rfkill(self, action: str):
+        """Run rfkill on the wifi device"""
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                "rfkill", action, "wifi",
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+        except OSError as e:
+            # Keep monitoring; the next high-latency check will try again
+            decky.logger.error(f"Failed to run rfkill {action}: {e}")
+            return
+        returncode = await proc.wait()
+        if returncode != 0:
+            decky.logger.error(f"rfkill {action} wifi exited with status {returncode}")
+
+    async def _emit_ping_result(self):
+        """Emit the last ping status unless it is a repeat of the previous one"""
+        last = self._last_emitted
+        if (
+            last is not None and
+            last["status"] == self.last_status["status"] and
+            abs(last["latency"] - self.last_status["latency"]) < _LATENCY_EMIT_DELTA
+        ):
+            return
+        self._last_emitted = self.last_status
+        await decky.emit("ping_result", self.last_status)
 
     async def _load_settings(self):
         """Load settings from file"""
         try:
-            settings_file = os.path.join(decky.DECKY_PLUGIN_SETTINGS_DIR, "LotusWiFi.json")
-            if os.path.exists(settings_file):
-                with open(settings_file, 'r') as f:
-                    saved_settings = json.load(f)
+            if os.path.exists(self.settings_file):
+                with open(self.settings_file, 'rb') as f:
+                    saved_settings = _loads(f.read())
                     self.settings.update(saved_settings)
         except Exception as e:
             decky.logger.error(f"Failed to load settings: {e}")
@@ -239,10 +292,26 @@ class Plugin:
     async def _save_settings(self):
         """Save settings to file"""
         try:
-            settings_file = os.path.join(decky.DECKY_PLUGIN_SETTINGS_DIR, "LotusWiFi.json")
+            data = _dumps(self.settings)
+            settings_hash = hashlib.blake2b(data, digest_size=8).hexdigest()
+            if settings_hash == self._settings_hash:
+                return
+
             os.makedirs(decky.DECKY_PLUGIN_SETTINGS_DIR, exist_ok=True)
-            with open(settings_file, 'w') as f:
-                json.dump(self.settings, f, indent=2)
+
+            # Write a temp file in one go and swap it in so a crash can't leave a torn file
+            temp_path = self.settings_file + ".tmp"
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                # os.write may write less than asked; never swap in a partial file
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(temp_path, self.settings_file)
+            self._settings_hash = settings_hash
         except Exception as e:
             decky.logger.error(f"Failed to save settings: {e}")
 
@@ -250,12 +319,6 @@ class Plugin:
         self.loop = asyncio.get_event_loop()
         decky.logger.info("LotusWiFi plugin loaded")
         
-        # Make sure the script is executable
-        if os.path.exists(self.script_path):
-            os.chmod(self.script_path, 0o755)
-        else:
-            decky.logger.error(f"Script not found at {self.script_path}")
-        
         await self._load_settings()
         
         # Start monitoring if it was enabled